@@ -1,12 +1,19 @@
+import json
 import os
 import uuid
-from datetime import datetime
-from typing import Optional, Any, List
-
-import requests
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Annotated, Optional, Any, List
+from urllib.parse import quote
+
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, TypeAdapter, field_serializer
 from dotenv import load_dotenv  # ← .env を読むために追加
 
 # .env を読み込む
@@ -25,17 +32,30 @@ if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     )
 
 
-def supabase_headers() -> dict:
-    return {
-        "apikey": SUPABASE_SERVICE_ROLE_KEY,
-        "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=representation",
-    }
+# 全リクエスト共通なので起動時に 1 回だけ組み立てて AsyncClient に載せる
+SUPABASE_HEADERS = {
+    "apikey": SUPABASE_SERVICE_ROLE_KEY,
+    "Authorization": f"Bearer {SUPABASE_SERVICE_ROLE_KEY}",
+    "Content-Type": "application/json",
+    "Prefer": "return=representation",
+}
+
+
+# INSERT は結果行を返させない（送った payload から Job を組み立てる）
+PREFER_MINIMAL = {"Prefer": "return=minimal"}
+
+
+def dumps_json(data: Any) -> bytes:
+    try:
+        return orjson.dumps(data)
+    except orjson.JSONEncodeError:
+        # orjson は 64bit を超える整数を扱えない（ai_result / workers に入りうる）ので標準 json に戻す
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
 
 
-def supabase_table_url(table: str) -> str:
-    return f"{SUPABASE_URL}/rest/v1/{table}"
+def postgrest_quote(value: str) -> str:
+    # in.(...) の要素に , や ( ) が含まれても壊れないようにダブルクォートで囲む
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
 
 
 # ==========================================================
@@ -58,8 +78,14 @@ class JobBase(BaseModel):
 
 class Job(JobBase):
     job_id: str
-    created_at: datetime
-    updated_at: datetime
+    # serializer が str を返しても OpenAPI 上は date-time のままにする
+    created_at: datetime = Field(json_schema_extra={"format": "date-time"})
+    updated_at: datetime = Field(json_schema_extra={"format": "date-time"})
+
+    @field_serializer("created_at", "updated_at")
+    def serialize_timestamp(self, value: datetime) -> str:
+        # /v1/jobs は PostgREST の文字列をそのまま返すので、同じ +00:00 形式にそろえる（Z にしない）
+        return value.isoformat()
 
 
 class JobUpdate(BaseModel):
@@ -76,9 +102,15 @@ class JobUpdate(BaseModel):
     ai_result: Optional[Any] = None
 
 
-class VolumeEstimateRequest(JobBase):
-    """立米AI用のリクエスト。今は JobBase と同じ構造。"""
-    pass
+# 立米AI用のリクエスト。今は JobBase と同じ構造なので別名にしてスキーマ構築を 1 回で済ませる
+# （フィールドを足すときはサブクラスに戻す）
+VolumeEstimateRequest = JobBase
+
+
+class JobBatchGetRequest(BaseModel):
+    # in.(...) は URL に載るので件数と 1 件あたりの長さを制限する
+    # （UUID 100 件で約 4.3KB。最終的な長さは supabase_select_jobs_by_ids で確認する）
+    ids: List[Annotated[str, Field(max_length=64)]] = Field(..., min_length=1, max_length=100)
 
 
 class VolumeEstimateResponse(BaseModel):
@@ -86,17 +118,49 @@ class VolumeEstimateResponse(BaseModel):
     message: str = "ok"
 
 
+# Supabase のレスポンス bytes → List[Job] を 1 パスで行う
+JOBS_ADAPTER = TypeAdapter(List[Job])
+
+
 # ==========================================================
 # ③ FastAPI 初期化
 # ==========================================================
 
-app = FastAPI(title="Ryubee API (Supabase version)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Supabase への接続は 1 つの AsyncClient を使い回す（keep-alive / HTTP/2）
+    # 接続失敗だけを再試行する（送信済みのリクエストは再送しない）
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        retries=3,
+    )
+    async with httpx.AsyncClient(
+        base_url=SUPABASE_URL,
+        headers=SUPABASE_HEADERS,
+        transport=transport,
+        timeout=10.0,
+    ) as http:
+        app.state.http = http
+        yield
+
+
+app = FastAPI(title="Ryubee API (Supabase version)", lifespan=lifespan)
+
+# 許可するオリジンは .env の CORS_ALLOW_ORIGINS（カンマ区切り）で絞る。未設定なら全許可
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ALLOW_ORIGINS", "*").split(",")
+    if origin.strip()
+]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # 本番で必要ならドメインを絞る
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    expose_headers=["Content-Range"],  # /v1/jobs のページング用
+    max_age=86400,  # プリフライト結果をブラウザに 1 日キャッシュさせる
 )
 
 
@@ -105,11 +169,28 @@ app.add_middleware(
 # ==========================================================
 
 TABLE = "jobs"
+# AsyncClient の base_url (SUPABASE_URL) からの相対パス
+JOBS_URL = f"/rest/v1/{TABLE}"
 
+# /v1/jobs は Supabase の bytes をそのまま返すので、Job のカラムだけを取得する
+JOB_COLUMNS = ",".join(Job.model_fields)
 
-def supabase_insert_job(data: dict) -> Job:
-    url = supabase_table_url(TABLE)
-    now = datetime.utcnow().isoformat()
+# よく使うクエリ文字列は先に組み立てておき、job_id だけ後ろに付ける
+JOBS_LIST_URL = f"{JOBS_URL}?select={JOB_COLUMNS}&order=created_at.desc"
+JOBS_BY_ID_URL = f"{JOBS_URL}?select=*&job_id=eq."
+JOBS_BY_IDS_URL = f"{JOBS_URL}?select={JOB_COLUMNS}&job_id=in."
+# in.(...) 部分の上限。ゲートウェイの request line 上限（nginx / Kong は 8KB）に収める
+JOBS_BY_IDS_MAX_LEN = 6000
+
+# 同じ job の連続読み込み（詳細画面 → PDF など）用の短命キャッシュ。
+# イベントループ上でだけ触るのでロックは不要
+JOB_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=5)
+# 更新のたびに進める。読み込み中に更新が挟まったら、その読み込み結果はキャッシュしない
+JOB_CACHE_GENERATION = 0
+
+
+async def supabase_insert_job(data: dict) -> Job:
+    now = datetime.now(timezone.utc).isoformat()
 
     payload = [{
         "job_id": data.get("job_id", str(uuid.uuid4())),
@@ -118,63 +199,114 @@ def supabase_insert_job(data: dict) -> Job:
         **data,
     }]
 
-    res = requests.post(url, headers=supabase_headers(), json=payload)
-    if not res.ok:
+    res = await app.state.http.post(JOBS_URL, headers=PREFER_MINIMAL, content=dumps_json(payload))
+    if not res.is_success:
         raise HTTPException(500, f"Supabase insert error: {res.text}")
 
-    return Job(**res.json()[0])
+    return Job(**payload[0])
+
 
+async def supabase_select_job(job_id: str) -> Job:
+    cached = JOB_CACHE.get(job_id)
+    if cached is not None:
+        return cached
 
-def supabase_select_job(job_id: str) -> Job:
-    url = supabase_table_url(TABLE)
-    params = {"job_id": f"eq.{job_id}", "select": "*"}
-    res = requests.get(url, headers=supabase_headers(), params=params)
+    generation = JOB_CACHE_GENERATION
+    res = await app.state.http.get(JOBS_BY_ID_URL + quote(job_id, safe=""))
 
-    if not res.ok:
+    if not res.is_success:
         raise HTTPException(500, f"Supabase select error: {res.text}")
 
-    data = res.json()
-    if not data:
+    rows = JOBS_ADAPTER.validate_json(res.content)
+    if not rows:
         raise HTTPException(404, "job not found")
 
-    return Job(**data[0])
+    if generation == JOB_CACHE_GENERATION:
+        JOB_CACHE[job_id] = rows[0]
+    return rows[0]
 
 
-def supabase_select_jobs() -> List[Job]:
-    url = supabase_table_url(TABLE)
-    params = {"select": "*", "order": "created_at.desc"}
-    res = requests.get(url, headers=supabase_headers(), params=params)
+async def supabase_get_stream(url: str, headers: Optional[dict] = None) -> httpx.Response:
+    # 本文は読まずに返す（呼び出し側で読み切るか aclose すること）
+    http = app.state.http
+    res = await http.send(http.build_request("GET", url, headers=headers), stream=True)
 
-    if not res.ok:
+    if not res.is_success:
+        await res.aread()
+        await res.aclose()
+        if res.status_code == 414:
+            raise HTTPException(422, "リクエストが大きすぎます（ids を減らしてください）")
         raise HTTPException(500, f"Supabase select error: {res.text}")
 
-    return [Job(**item) for item in res.json()]
+    return res
+
+
+async def supabase_select_jobs(limit: int, offset: int) -> httpx.Response:
+    headers = {"Range-Unit": "items", "Range": f"{offset}-{offset + limit - 1}"}
+    return await supabase_get_stream(JOBS_LIST_URL, headers)
+
+
+async def supabase_select_jobs_by_ids(ids: List[str]) -> httpx.Response:
+    quoted = ",".join(postgrest_quote(i) for i in ids)
+    # PostgREST の構文文字 ( ) , はエスケープしない（1 文字が 3 文字に膨らむため）
+    in_list = quote(f"({quoted})", safe="(),")
+    if len(in_list) > JOBS_BY_IDS_MAX_LEN:
+        raise HTTPException(422, "ids が長すぎます（件数を減らしてください）")
 
+    return await supabase_get_stream(JOBS_BY_IDS_URL + in_list)
 
-def supabase_update_job(job_id: str, data: dict) -> Job:
-    url = supabase_table_url(TABLE)
-    data["updated_at"] = datetime.utcnow().isoformat()
 
-    params = {"job_id": f"eq.{job_id}", "select": "*"}
-    res = requests.patch(url, headers=supabase_headers(), params=params, json=data)
+async def supabase_update_job(job_id: str, data: dict) -> Job:
+    global JOB_CACHE_GENERATION
+    data["updated_at"] = datetime.now(timezone.utc).isoformat()
 
-    if not res.ok:
+    url = JOBS_BY_ID_URL + quote(job_id, safe="")
+    res = await app.state.http.patch(url, content=dumps_json(data))
+
+    if not res.is_success:
         raise HTTPException(500, f"Supabase update error: {res.text}")
 
-    return Job(**res.json()[0])
+    JOB_CACHE_GENERATION += 1
+    rows = JOBS_ADAPTER.validate_json(res.content)
+    if not rows:
+        raise HTTPException(404, "job not found")
+
+    JOB_CACHE[job_id] = rows[0]
+    return rows[0]
 
 
 # ==========================================================
 # ⑤ API エンドポイント
 # ==========================================================
 
+def json_response(model: BaseModel) -> Response:
+    # response_model での再検証を通さず、そのまま JSON bytes にして返す
+    return Response(model.model_dump_json(), media_type="application/json")
+
+
+def stream_response(res: httpx.Response) -> StreamingResponse:
+    # Supabase の本文をメモリに溜めず、届いた分からそのままクライアントへ流す。
+    # 途中で切断されても background で必ず接続をプールに返す
+    # ページングの有無がわかるよう PostgREST の 206 / Content-Range はそのまま返す
+    headers = {}
+    if "content-range" in res.headers:
+        headers["Content-Range"] = res.headers["content-range"]
+    return StreamingResponse(
+        res.aiter_bytes(),
+        status_code=res.status_code,
+        headers=headers,
+        media_type="application/json",
+        background=BackgroundTask(res.aclose),
+    )
+
+
 @app.get("/v1/health")
 def health_check():
     return {"status": "ok"}
 
 
 @app.post("/v1/volume-estimate", response_model=VolumeEstimateResponse)
-def create_and_estimate(payload: VolumeEstimateRequest):
+async def create_and_estimate(payload: VolumeEstimateRequest):
     """
     ここに現在の AI 立米計算ロジックを移植してください。
     ↓ この3つを埋めて Supabase 保存
@@ -183,34 +315,60 @@ def create_and_estimate(payload: VolumeEstimateRequest):
     - ai_result
     """
     # TODO: OpenAI を呼び出して total_volume_m3 / price_total / ai_result を計算する処理をここに入れる
+    #       イベントループを止めないよう AsyncOpenAI を使い
+    #       `await client.chat.completions.create(...)` で呼ぶこと
 
-    job = supabase_insert_job(payload.dict())
-    return VolumeEstimateResponse(job=job)
+    job = await supabase_insert_job(payload.model_dump(mode="json"))
+    return json_response(VolumeEstimateResponse(job=job))
 
 
 @app.get("/v1/jobs", response_model=List[Job])
-def list_jobs():
-    return supabase_select_jobs()
+async def list_jobs(
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+):
+    """
+    created_at の新しい順に最大 limit 件（既定 50 件）を返す。
+    続きがあるかはレスポンスの Content-Range（例: `0-49/*`）で判断し、offset をずらして取得する。
+    """
+    # Response を直接返すので response_model はスキーマ表示用
+    return stream_response(await supabase_select_jobs(limit, offset))
+
+
+@app.post("/v1/jobs:batchGet", response_model=List[Job])
+async def batch_get_jobs(payload: JobBatchGetRequest):
+    # /v1/jobs/{job_id} を N 回呼ぶ代わりに 1 回の Supabase 問い合わせで取得する
+    return stream_response(await supabase_select_jobs_by_ids(payload.ids))
 
 
 @app.get("/v1/jobs/{job_id}", response_model=Job)
-def get_job(job_id: str):
-    return supabase_select_job(job_id)
+async def get_job(job_id: str):
+    return json_response(await supabase_select_job(job_id))
 
 
 @app.post("/v1/jobs/{job_id}", response_model=Job)
-def update_job(job_id: str, payload: JobUpdate):
-    return supabase_update_job(job_id, payload.dict(exclude_unset=True))
+async def update_job(job_id: str, payload: JobUpdate):
+    data = payload.model_dump(exclude_unset=True, mode="json")
+    if not data:
+        # 空ボディ（変更なし）は PATCH せず現在の job を返す
+        return json_response(await supabase_select_job(job_id))
+
+    job = await supabase_update_job(job_id, data)
+    return json_response(job)
 
 
 @app.get("/v1/jobs/{job_id}/worksheet")
-def job_pdf(job_id: str):
+async def job_pdf(job_id: str):
     # ここで job を取得して PDF を生成する
-    job = supabase_select_job(job_id)
+    job = await supabase_select_job(job_id)
     # TODO: 既存の PDF 生成ロジックをここに移植
+    #       reportlab は同期処理なので `await run_in_threadpool(generate_pdf, job)` で
+    #       スレッドプールに逃がすこと（fastapi.concurrency.run_in_threadpool）
     raise HTTPException(501, "PDF ロジック未実装（既存PDF生成をここに貼り付け）")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # 開発時のホットリロードは `uvicorn main:app --reload` を使う
+    # loop / http は既定の "auto" で uvloop / httptools があれば使われる
+    uvicorn.run(app, host="0.0.0.0", port=8000, access_log=False)